@@ -7,16 +7,23 @@ The core logic is based on adenzu Eren, the Manga Panel Extractor.
 Copyright (c) 2023 Eren
 """
 import gradio as gr
+import gc
 import os
 import cv2
 import numpy as np
-import shutil
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import partial
+from itertools import repeat
 from tqdm import tqdm
 from datetime import datetime
 
-from image_processing.panel import generate_panel_blocks, generate_panel_blocks_by_ai
+from image_processing.panel import AI_BATCH_SIZE, generate_panel_blocks, generate_panel_blocks_by_ai_batch
+from image_processing.model import model
 from manga_panel_processor import remove_border
 
+__all__ = ["process_images", "main"]
+
 # --- UI Description ---
 DESCRIPTION = """
 # adenzu Eren Manga/Comics Panel Extractor (WebUI)
@@ -27,6 +34,173 @@ Finally, all extracted panels are packaged into a single ZIP file for you to dow
 The Core package author: **adenzu Eren** ([Original Project](https://github.com/adenzu/Manga-Panel-Extractor)).
 """
 
+# Number of processed images between explicit garbage collections.
+GC_INTERVAL = 16
+
+# Output formats whose data is already compressed, their archive entries are stored as is.
+# Every other format (e.g. .bmp, .ppm, .hdr) is deflated like shutil.make_archive did.
+STORED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.jpe', '.webp', '.jp2'}
+
+# Shared by all images and requests, so the threads are created only once.
+_encode_executor = ThreadPoolExecutor(max_workers=4)
+
+
+def _read_image(path):
+    """
+    Reads an image with Unicode path support.
+    cv2.imread cannot open non-ASCII paths on every platform, so those are read into
+    a numpy buffer first and decoded from memory. Plain paths are read directly.
+    """
+    if path.isascii():
+        return cv2.imread(path, cv2.IMREAD_COLOR)
+    return cv2.imdecode(np.fromfile(path, np.uint8), cv2.IMREAD_COLOR)
+
+
+def _encode_panel(panel, save_ext, remove_borders):
+    """
+    Encodes a single panel to an in-memory buffer based on the file extension.
+    Returns None if the panel could not be encoded.
+    """
+    # A failing panel (e.g. an empty crop) must not discard the other panels of its image.
+    try:
+        if remove_borders:
+            panel = remove_border(panel)
+        is_success, buffer = cv2.imencode(save_ext, panel)
+    except Exception as e:
+        print(f"Error encoding a panel: {e}")
+        return None
+    # The encoded uint8 array is handed over as is, its bytes are only copied once written.
+    return buffer if is_success else None
+
+
+def _encode_panel_blocks(original_filename, image, panel_blocks, options):
+    """
+    Encodes the panel blocks extracted from one image.
+    Returns a list of (relative_path, encoded_buffer) tuples.
+    """
+    filename_no_ext, file_ext = os.path.splitext(original_filename)
+
+    # If no panels were detected, use the original image as a single panel.
+    if not panel_blocks:
+        print(f"Warning: No panels found in {original_filename}. Using the original image.")
+        panel_blocks = [image]
+
+    # Encode the panels concurrently, cv2.imencode releases the GIL while compressing.
+    save_ext = file_ext if file_ext else '.png'
+    buffers = _encode_executor.map(
+        _encode_panel, panel_blocks, repeat(save_ext), repeat(options["remove_borders"])
+    )
+    # Everything but the panel index only depends on the image, so it is computed once.
+    if options["separate_folders"]:
+        # e.g., image_name/panel_0.png
+        panel_filename_prefix = f"{filename_no_ext}/panel_"
+    else:
+        # e.g., image_name_panel_0.png
+        panel_filename_prefix = f"{filename_no_ext}_panel_"
+
+    encoded_panels = []
+    for i, buffer in enumerate(buffers):
+        panel_filename = f"{panel_filename_prefix}{i}{save_ext}"
+
+        if buffer is None:
+            print(f"Warning: Could not encode panel {panel_filename}. Skipping.")
+            continue
+        encoded_panels.append((panel_filename, buffer))
+
+    return encoded_panels
+
+
+def _process_one(image_path, options):
+    """
+    Extracts the panels of a single image with the Traditional method and encodes them in memory.
+    This runs on a worker thread, the OpenCV calls it spends its time in release the GIL.
+    Returns a list of (relative_path, encoded_buffer) tuples.
+    """
+    original_filename = os.path.basename(image_path)
+    try:
+        image = _read_image(image_path)
+
+        if image is None:
+            print(f"Warning: Could not read or decode image {original_filename}. Skipping.")
+            return []
+
+        panel_blocks = generate_panel_blocks(
+            image=image,
+            split_joint_panels=options["split_joint"],
+            fallback=options["fallback"],
+            mode=options["output_mode"],
+            merge=options["merge_mode"],
+            rtl_order=options["rtl_order"]
+        )
+        return _encode_panel_blocks(original_filename, image, panel_blocks, options)
+
+    except Exception as e:
+        print(f"Error processing {original_filename}: {e}")
+        # Optionally, re-raise as a Gradio error to notify the user.
+        # raise gr.Error(f"Failed to process {original_filename}: {e}")
+        return []
+
+
+def _process_ai_batch(image_paths, options):
+    """
+    Extracts the panels of several images with the AI method, running the model once
+    for the whole batch, and encodes them in memory.
+    Returns one list of (relative_path, encoded_buffer) tuples per image.
+    """
+    results = [[] for _ in image_paths]
+
+    # Decode the whole batch first, skipping the images that cannot be read.
+    loaded = []
+    for index, image_path in enumerate(image_paths):
+        original_filename = os.path.basename(image_path)
+        try:
+            image = _read_image(image_path)
+        except Exception as e:
+            print(f"Error processing {original_filename}: {e}")
+            continue
+        if image is None:
+            print(f"Warning: Could not read or decode image {original_filename}. Skipping.")
+            continue
+        loaded.append((index, original_filename, image))
+
+    if not loaded:
+        return results
+
+    try:
+        batch_panel_blocks = generate_panel_blocks_by_ai_batch(
+            images=[image for _, _, image in loaded],
+            merge=options["merge_mode"],
+            rtl_order=options["rtl_order"]
+        )
+    except Exception as e:
+        print(f"Error processing {', '.join(name for _, name, _ in loaded)}: {e}")
+        return results
+
+    for (index, original_filename, image), panel_blocks in zip(loaded, batch_panel_blocks):
+        try:
+            results[index] = _encode_panel_blocks(original_filename, image, panel_blocks, options)
+        except Exception as e:
+            print(f"Error processing {original_filename}: {e}")
+
+    return results
+
+
+def _imap_bounded(executor, fn, iterable, max_in_flight):
+    """
+    Like executor.map, but yields the results in completion order and keeps at most
+    max_in_flight tasks submitted, so finished results are consumed instead of piling up in memory.
+    """
+    pending = set()
+    for item in iterable:
+        pending.add(executor.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in as_completed(pending):
+        yield future.result()
+
+
 def process_images(
     input_files,
     method,
@@ -49,125 +223,88 @@ def process_images(
     if not input_files:
         raise gr.Error("No images uploaded. Please upload at least one image.")
 
-    # Create a unique, temporary sub-directory inside the 'output' folder for this run.
+    # The ZIP file is created inside the 'output' folder with a unique name for this run.
     main_output_dir = "output"
     os.makedirs(main_output_dir, exist_ok=True)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    
-    # All intermediate panel files will be stored here before being zipped.
-    # This directory will be created inside 'output' and removed after zipping.
-    panel_output_dir = os.path.join(main_output_dir, f"temp_panels_{timestamp}")
-    os.makedirs(panel_output_dir)
-
+    final_zip_path = os.path.join(main_output_dir, f"adenzu_output_{timestamp}.zip")
+
+    # Settings shared by every worker.
+    options = {
+        "method": method,
+        "separate_folders": separate_folders,
+        "rtl_order": rtl_order,
+        "remove_borders": remove_borders,
+        "merge_mode": merge_mode,
+        "split_joint": split_joint,
+        "fallback": fallback,
+        "output_mode": output_mode,
+    }
+    # The image_file object from gr.Files has a .name attribute with the temp path
+    image_paths = [image_file.name for image_file in input_files]
+
+    num_panels = 0
     try:
-        for image_file in tqdm(input_files, desc="Processing Images"):
-            try:
-                # The image_file object from gr.Files has a .name attribute with the temp path
-                original_filename = os.path.basename(image_file.name)
-                filename_no_ext, file_ext = os.path.splitext(original_filename)
-                
-                # Read image with Unicode path support to handle non-ASCII filenames.
-                # Read the file into a numpy array first.
-                stream = np.fromfile(image_file.name, np.uint8)
-                # Decode the numpy array into an image.
-                image = cv2.imdecode(stream, cv2.IMREAD_COLOR)
-
-                if image is None:
-                    print(f"Warning: Could not read or decode image {original_filename}. Skipping.")
-                    continue
-
-                # Select the processing function based on the chosen method
-                if method == "Traditional":
-                    panel_blocks = generate_panel_blocks(
-                        image=image,
-                        split_joint_panels=split_joint,
-                        fallback=fallback,
-                        mode=output_mode,
-                        merge=merge_mode,
-                        rtl_order=rtl_order
-                    )
-                elif method == "AI":
-                    panel_blocks = generate_panel_blocks_by_ai(
-                        image=image,
-                        merge=merge_mode,
-                        rtl_order=rtl_order
-                    )
-                else:
-                    # Should not happen with Radio button selection
-                    panel_blocks = []
-
-                # If no panels were detected, use the original image as a single panel.
-                if not panel_blocks:
-                    print(f"Warning: No panels found in {original_filename}. Using the original image.")
-                    panel_blocks = [image]
-
-                # Determine the output path for the panels of this image
-                if separate_folders:
-                    # Create a sub-directory for each image
-                    image_output_folder = os.path.join(panel_output_dir, filename_no_ext)
-                    os.makedirs(image_output_folder, exist_ok=True)
-                else:
-                    # Output all panels to the root of the temp directory
-                    image_output_folder = panel_output_dir
-
-                # Save each panel block
-                for i, panel in enumerate(panel_blocks):
-                    if remove_borders:
-                        panel = remove_border(panel)
-                    
-                    save_ext = file_ext if file_ext else '.png'
-                    if separate_folders:
-                        # e.g., /tmp/xyz/image_name/panel_0.png
-                        panel_filename = f"panel_{i}{save_ext}"
+        # Panels are streamed straight into the archive, no intermediate files are written.
+        # The compression is chosen per entry, see STORED_EXTENSIONS.
+        # A large write buffer keeps the many small entries from turning into many small writes.
+        with open(final_zip_path, 'wb', buffering=1 << 20) as zip_file, \
+                zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            def write_panels(encoded_panels):
+                nonlocal num_panels
+                # The archive is written on the main thread, workers only return the encoded bytes.
+                for arcname, buffer in encoded_panels:
+                    if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS:
+                        compress_type = zipfile.ZIP_STORED
                     else:
-                        # e.g., /tmp/xyz/image_name_panel_0.png
-                        panel_filename = f"{filename_no_ext}_panel_{i}{save_ext}"
-
-                    output_path = os.path.join(image_output_folder, panel_filename)
-                    
-                    # Write image with Unicode path support.
-                    # Encode the image to a memory buffer based on the file extension.
-                    is_success, buffer = cv2.imencode(save_ext, panel)
-                    if not is_success:
-                        print(f"Warning: Could not encode panel {panel_filename}. Skipping.")
-                        continue
-                    # Write the buffer to a file using Python's standard I/O.
-                    with open(output_path, 'wb') as f:
-                        f.write(buffer)
-
-            except Exception as e:
-                print(f"Error processing {original_filename}: {e}")
-                # Optionally, re-raise as a Gradio error to notify the user.
-                # raise gr.Error(f"Failed to process {original_filename}: {e}")
-                
-        # After processing all images, check if any panels were generated
-        if not os.listdir(panel_output_dir):
-            raise gr.Error("Processing complete, but no panels were extracted from any of the images.")
-
-        # --- Create a zip file in the 'output' directory ---
-        zip_filename_base = f"adenzu_output_{timestamp}"
-
-        # Define the full path for our archive (path + filename without extension).
-        zip_path_base = os.path.join(main_output_dir, zip_filename_base)
-        
-        # Create the zip file from the temporary panel directory.
-        final_zip_path = shutil.make_archive(
-            base_name=zip_path_base,
-            format='zip',
-            root_dir=panel_output_dir
-        )
-        
-        print(f"Created ZIP file at: {final_zip_path}")
-        # The function returns the full path to the created zip file.
-        # Gradio takes this path and provides it as a download link.
-        return final_zip_path
-
-    finally:
-        # Clean up the temporary panel directory, leaving only the final ZIP file.
-        # This block executes whether the 'try' block succeeds or fails.
-        if os.path.exists(panel_output_dir):
-            print(f"Cleaning up temporary panel directory: {panel_output_dir}")
-            shutil.rmtree(panel_output_dir)
+                        compress_type = zipfile.ZIP_DEFLATED
+                    # memoryview avoids the extra copy that buffer.tobytes() would make.
+                    zf.writestr(arcname, memoryview(buffer).cast('B'), compress_type=compress_type)
+                    num_panels += 1
+
+            if method == "AI":
+                # The model runs on batches of pages instead of one page at a time.
+                with tqdm(
+                    total=len(image_paths), desc="Processing Images", mininterval=0.5, disable=len(image_paths) == 1
+                ) as progress_bar:
+                    for start in range(0, len(image_paths), AI_BATCH_SIZE):
+                        batch = image_paths[start:start + AI_BATCH_SIZE]
+                        for encoded_panels in _process_ai_batch(batch, options):
+                            write_panels(encoded_panels)
+                        progress_bar.update(len(batch))
+            elif len(image_paths) == 1:
+                # A single image is not worth the cost of starting worker threads.
+                write_panels(_process_one(image_paths[0], options))
+            else:
+                # Pipeline: worker threads decode and detect, the shared encoder pool encodes,
+                # and this thread writes the archive as results arrive. Threads avoid pickling
+                # pages and panels between processes. Two cores are left for the other stages.
+                max_workers = min(len(image_paths), max(1, (os.cpu_count() or 1) - 2))
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    results = _imap_bounded(executor, partial(_process_one, options=options), image_paths, 2 * max_workers)
+                    # Progress updates are rate limited, every update is a message to the Gradio frontend.
+                    progress_bar = tqdm(results, total=len(image_paths), desc="Processing Images", mininterval=0.5)
+                    for index, encoded_panels in enumerate(progress_bar, 1):
+                        write_panels(encoded_panels)
+                        # Release the encoded panels as soon as they are in the archive.
+                        del encoded_panels
+                        if index % GC_INTERVAL == 0:
+                            gc.collect()
+    except BaseException:
+        # Do not leave a partial archive behind if processing fails.
+        if os.path.exists(final_zip_path):
+            os.remove(final_zip_path)
+        raise
+
+    # After processing all images, check if any panels were generated
+    if num_panels == 0:
+        os.remove(final_zip_path)
+        raise gr.Error("Processing complete, but no panels were extracted from any of the images.")
+
+    print(f"Created ZIP file at: {final_zip_path}")
+    # The function returns the full path to the created zip file.
+    # Gradio takes this path and provides it as a download link.
+    return final_zip_path
 
 
 def main():
@@ -259,6 +396,18 @@ def main():
                     outputs=[traditional_params, ai_params]
                 )
 
+                # Load the AI model as soon as it is selected, so the first request does not pay for it
+                def preload_model(selected_method):
+                    if selected_method == "AI":
+                        model.load()
+
+                method.change(
+                    fn=preload_model,
+                    inputs=method,
+                    outputs=None,
+                    show_progress="hidden"
+                )
+
                 # --- Action Button ---
                 generate_button = gr.Button("Generate Panels", variant="primary")
 
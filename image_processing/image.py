@@ -19,6 +19,80 @@ def is_contour_rectangular(contour: np.ndarray) -> bool:
     return len(approx) == num_sides
 
 
+def build_thinning_lookup_tables() -> tuple[np.ndarray, np.ndarray]:
+    """
+    Builds the Zhang-Suen removal decisions of the two sub-iterations for every 8 neighborhood,
+    the neighbors are the bits of the index clockwise from north: N, NE, E, SE, S, SW, W, NW
+    """
+    first_lookup_table = np.zeros(256, bool)
+    second_lookup_table = np.zeros(256, bool)
+    for neighborhood in range(256):
+        neighbors = [(neighborhood >> bit) & 1 for bit in range(8)]
+        north, _, east, _, south, _, west, _ = neighbors
+        # Number of 0 to 1 transitions around the pixel and number of set neighbors
+        transitions = sum(1 for bit in range(8) if neighbors[bit] == 0 and neighbors[(bit + 1) % 8] == 1)
+        set_neighbors = sum(neighbors)
+        if transitions != 1 or not 2 <= set_neighbors <= 6:
+            continue
+        first_lookup_table[neighborhood] = north * east * south == 0 and east * south * west == 0
+        second_lookup_table[neighborhood] = north * east * west == 0 and north * south * west == 0
+    return first_lookup_table, second_lookup_table
+
+
+THINNING_LOOKUP_TABLES = build_thinning_lookup_tables()
+
+
+def thin_binary_image(image: np.ndarray) -> np.ndarray:
+    """
+    Same as cv2.ximgproc.thinning (Zhang-Suen) for a 0/255 image
+
+    The pixels to check are kept as index arrays, a pixel is only checked again once one of its
+    neighbors was removed, so after the first pass a round costs as much as the pixels it removes
+    """
+    image_height, image_width = image.shape
+    thinned_image = (image != 0).astype(np.uint8)
+    flat_image = thinned_image.ravel()
+    # Same order as the bits of THINNING_LOOKUP_TABLES
+    neighbor_offsets = np.array([-image_width, -image_width + 1, 1, image_width + 1, image_width, image_width - 1, -1, -image_width - 1])
+
+    def interior_pixels(indices: np.ndarray) -> np.ndarray:
+        # Pixels on the image border are never removed
+        rows, columns = np.divmod(indices, image_width)
+        return indices[(rows > 0) & (rows < image_height - 1) & (columns > 0) & (columns < image_width - 1)]
+
+    def sorted_unique(indices: np.ndarray) -> np.ndarray:
+        # A plain sort, np.unique may go through a hash table which is slower for these small arrays
+        indices = np.sort(indices)
+        return indices[np.concatenate(([True], indices[1:] != indices[:-1]))] if indices.size else indices
+
+    foreground = interior_pixels(np.flatnonzero(flat_image))
+    indices_to_check = [foreground for _ in THINNING_LOOKUP_TABLES]
+
+    while any(indices.size for indices in indices_to_check):
+        for sub_iteration, lookup_table in enumerate(THINNING_LOOKUP_TABLES):
+            indices = indices_to_check[sub_iteration]
+            # Pixels removed since they were queued are not part of the shape anymore
+            indices = indices[flat_image[indices] != 0]
+            indices_to_check[sub_iteration] = indices[:0]
+            if indices.size == 0:
+                continue
+
+            neighborhoods = np.zeros(indices.size, np.uint8)
+            for bit, offset in enumerate(neighbor_offsets):
+                neighborhoods |= flat_image[indices + offset] << bit
+            # All the pixels of a sub-iteration are removed at once, as in cv2.ximgproc.thinning
+            removed = indices[lookup_table[neighborhoods]]
+            if removed.size == 0:
+                continue
+            flat_image[removed] = 0
+
+            neighbors = (removed[:, np.newaxis] + neighbor_offsets).ravel()
+            neighbors = interior_pixels(neighbors[flat_image[neighbors] != 0])
+            indices_to_check = [sorted_unique(np.concatenate((queued, neighbors))) for queued in indices_to_check]
+
+    return thinned_image * 255
+
+
 def adaptive_vconcat(images: list[np.ndarray], fill_color: tuple[int, int, int] = (255, 255, 255)) -> np.ndarray:
     max_width = max(img.shape[1] for img in images)
 
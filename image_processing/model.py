@@ -1,11 +1,18 @@
+import threading
+
+
 class Model:
     def __init__(self):
         self.model = None
         self.imported = False
+        # Guards the one-time load against concurrent requests
+        self._lock = threading.Lock()
 
     def load(self):
         if self.model is None:
-            self.__load()
+            with self._lock:
+                if self.model is None:
+                    self.__load()
 
     def __load(self):
         if not self.imported:
@@ -19,11 +26,17 @@ class Model:
             from myutils.respath import resource_path
             from yolov5.models.yolo import DetectionModel
 
+            # Skip the GitHub API request that checks whether the hub repo is a fork
+            torch.hub._validate_not_a_forked_repo = lambda *args, **kwargs: True
+
             # Add DetectionModel to safe globals—must be inside context that covers load
             torch.serialization.add_safe_globals([DetectionModel])
             
             # Context manager to ensure allowlisted globals during load
             self._safe_ctx = safe_globals([DetectionModel])
+
+            # Disables autograd bookkeeping for every inference call
+            self._inference_mode = torch.inference_mode
             
         # Redirect sys.stderr to a file or a valid stream
         if sys.stderr is None:
@@ -40,7 +53,7 @@ class Model:
                 pathlib.PosixPath = pathlib.WindowsPath
                 try:
                     # Load the model with the patch applied
-                    self.model = torch.hub.load(
+                    model = torch.hub.load(
                         'ultralytics/yolov5', 'custom',
                         path=resource_path('ai-models/2024-11-00/best.pt'),
                         force_reload=True
@@ -50,16 +63,28 @@ class Model:
                     pathlib.PosixPath = temp
             else:
                 # If on Linux, macOS, or other systems, load the model directly
-                self.model = torch.hub.load(
+                model = torch.hub.load(
                     'ultralytics/yolov5', 'custom',
                     path=resource_path('ai-models/2024-11-00/best.pt'),
                     force_reload=True
                 )
 
+        # The hub loader already fuses Conv+BatchNorm layers, only the inference settings are left
+        model.eval()
+        if torch.cuda.is_available():
+            # The model is placed on the GPU when one is available, run it in FP16 there
+            model.half()
+
+        # Only publish the model once it is ready, load() checks it without holding the lock
+        self.model = model
+
     def __call__(self, *args, **kwds):
-        if self.model is None:
-            self.__load()
-        return self.model(*args, **kwds)
+        """
+        Runs the model, either on a single image or on a list of images as one batch
+        """
+        self.load()
+        with self._inference_mode():
+            return self.model(*args, **kwds)
 
 # A no-op context in case safe_globals isn't set
 from contextlib import contextmanager
@@ -1,14 +1,24 @@
 import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 from typing import Callable
 import cv2
 import warnings
 import numpy as np
-from image_processing.image import is_contour_rectangular, apply_adaptive_threshold, group_contours_horizontally, group_contours_vertically, adaptive_hconcat, adaptive_vconcat, group_bounding_boxes_horizontally, group_bounding_boxes_vertically
-from myutils.myutils import load_images, load_image
+from image_processing.image import is_contour_rectangular, thin_binary_image, apply_adaptive_threshold, group_contours_horizontally, group_contours_vertically, adaptive_hconcat, adaptive_vconcat, group_bounding_boxes_horizontally, group_bounding_boxes_vertically
+from myutils.myutils import ImageWithFilename, load_image, get_file_names, get_file_extension, supported_types
 from tqdm import tqdm
 from image_processing.model import model
 from manga_panel_processor import sort_panels_by_column_then_row
 
+SQUARE_KERNEL_3 = np.ones((3, 3), np.uint8)
+SQUARE_KERNEL_5 = np.ones((5, 5), np.uint8)
+
+# Number of pages sent to the AI model in a single forward pass
+AI_BATCH_SIZE = 8
+
+
 class OutputMode:
     BOUNDING = 'bounding'
     MASKED = 'masked'
@@ -30,13 +40,17 @@ def get_background_intensity_range(grayscale_image: np.ndarray, min_range: int =
     """
     Returns the minimum and maximum intensity values of the background of the image
     """
-    edges = [grayscale_image[-1, :], grayscale_image[0, :], grayscale_image[:, 0], grayscale_image[:, -1]]
-    sorted_edges = sorted(edges, key=lambda x: np.var(x))
+    # Rows and columns differ in length, so each pair of edges is stacked and reduced on its own.
+    # The edge order (bottom, top, left, right) decides ties, as a stable sort by variance would.
+    row_edges = grayscale_image[[-1, 0], :]
+    column_edges = np.ascontiguousarray(grayscale_image[:, [0, -1]].T)
+    variances = np.concatenate((row_edges.var(axis=1), column_edges.var(axis=1)))
 
-    least_varied_edge = sorted_edges[0]
+    least_varied_index = int(np.argmin(variances))
+    least_varied_edge = row_edges[least_varied_index] if least_varied_index < 2 else column_edges[least_varied_index - 2]
 
-    max_intensity = max(least_varied_edge)
-    min_intensity = max(min(min(least_varied_edge), max_intensity - min_range), 0)
+    max_intensity = int(least_varied_edge.max())
+    min_intensity = max(min(int(least_varied_edge.min()), max_intensity - min_range), 0)
 
     return min_intensity, max_intensity
 
@@ -50,7 +64,11 @@ def generate_background_mask(grayscale_image: np.ndarray) -> np.ndarray:
     LESS_WHITE = max(LESS_WHITE, 240)
 
     ret, thresh = cv2.threshold(grayscale_image, LESS_WHITE, WHITE, cv2.THRESH_BINARY)
-    nlabels, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh)
+    # 16 bit labels halve the memory traffic, OpenCV raises when a page has more components than they can hold
+    try:
+        nlabels, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh, connectivity=8, ltype=cv2.CV_16U)
+    except cv2.error:
+        nlabels, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh, connectivity=8, ltype=cv2.CV_32S)
 
     mask = np.zeros_like(thresh)
 
@@ -68,14 +86,18 @@ def generate_background_mask(grayscale_image: np.ndarray) -> np.ndarray:
         x, y, w, h, area = stats[contour_index]
         if area < halting_area_size:
             break
+        # Only the bounding box of the component is compared, not the whole page,
+        # cv2.compare directly gives the 0/255 image used by both findContours and the mask.
+        # The index is a 1x1 array, cv2 rejects a plain number when the box is a single pixel too
+        component = cv2.compare(labels[y:y + h, x:x + w], np.full((1, 1), contour_index, labels.dtype), cv2.CMP_EQ)
         if (
             (w > whole_background_min_width) or
             (h > whole_background_min_height) or
-            (is_contour_rectangular(cv2.findContours((labels == contour_index).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0][0]))
+            (is_contour_rectangular(cv2.findContours(component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0][0]))
         ):
-            mask[labels == contour_index] = WHITE
+            mask[y:y + h, x:x + w] |= component
 
-    mask = cv2.dilate(mask, np.ones((3, 3), np.uint8), iterations=2)
+    mask = cv2.dilate(mask, SQUARE_KERNEL_3, iterations=2)
 
     return mask
 
@@ -110,11 +132,15 @@ def extract_panels(
             continue
 
         if mode == 'masked':
-            mask = np.zeros_like(image)
-            cv2.drawContours(mask, [contour], -1, (255, 255, 255), -1)
-            masked_image = cv2.bitwise_and(image, mask)
-            fitted_panel = masked_image[y:y + h, x:x + w]
-            fitted_panel = cv2.bitwise_or(cv2.bitwise_and(cv2.bitwise_not(mask[y:y + h, x:x + w]), fill_in_color), fitted_panel)
+            # Everything happens inside the bounding box, which holds the whole contour
+            panel_region = image[y:y + h, x:x + w]
+            # A single channel mask is enough, it is applied to every channel through the mask argument
+            mask = np.zeros((h, w), np.uint8)
+            cv2.drawContours(mask, [contour], -1, 255, -1, offset=(-x, -y))
+            fitted_panel = cv2.bitwise_and(panel_region, panel_region, mask=mask)
+            # The outside of the contour is 0 at this point, adding the color there fills it
+            if any(fill_in_color):
+                cv2.add(fitted_panel, fill_in_color, dst=fitted_panel, mask=cv2.bitwise_not(mask))
         else:
             fitted_panel = image[y:y + h, x:x + w]
         
@@ -123,45 +149,125 @@ def extract_panels(
     return returned_panels
 
 
+# Intermediate images of the preprocessing, kept per thread and reused by the next page of the same size
+scratch_buffers = threading.local()
+
+
+def get_scratch_buffer(name: str, shape: tuple[int, ...]) -> np.ndarray:
+    """
+    Returns the uint8 buffer of the current thread with the given name and shape,
+    its content is overwritten by the next call using the same name, so it must not be returned
+    """
+    buffer = getattr(scratch_buffers, name, None)
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, np.uint8)
+        setattr(scratch_buffers, name, buffer)
+    return buffer
+
+
 def preprocess_image(grayscale_image: np.ndarray) -> np.ndarray:
     """
     Preprocesses the image for panel extraction
     """
-    processed_image = cv2.GaussianBlur(grayscale_image, (3, 3), 0)
+    processed_image = cv2.GaussianBlur(grayscale_image, (3, 3), 0, dst=get_scratch_buffer("blurred", grayscale_image.shape))
     processed_image = cv2.Laplacian(processed_image, -1)
     return processed_image
 
 
-def preprocess_image_with_dilation(grayscale_image: np.ndarray) -> np.ndarray:
+def preprocess_image_with_dilation(grayscale_image: np.ndarray, precomputed_laplacian: np.ndarray | None = None) -> np.ndarray:
     """
-    Preprocesses the image for panel extraction
+    Preprocesses the image for panel extraction,
+    precomputed_laplacian is the result of preprocess_image when the caller already has it
     """
-    processed_image = cv2.GaussianBlur(grayscale_image, (3, 3), 0)
-    processed_image = cv2.Laplacian(processed_image, -1)
-    processed_image = cv2.dilate(processed_image, np.ones((5, 5), np.uint8), iterations=1)
-    processed_image = 255 - processed_image
+    if precomputed_laplacian is None:
+        processed_image = cv2.GaussianBlur(grayscale_image, (3, 3), 0, dst=get_scratch_buffer("blurred", grayscale_image.shape))
+        processed_image = cv2.Laplacian(processed_image, -1, dst=get_scratch_buffer("laplacian", grayscale_image.shape))
+    else:
+        processed_image = precomputed_laplacian
+    processed_image = cv2.dilate(processed_image, SQUARE_KERNEL_5, iterations=1)
+    processed_image = cv2.bitwise_not(processed_image, dst=processed_image)
     return processed_image
 
 
-def joint_panel_split_extraction(grayscale_image: np.ndarray, background_mask: np.ndarray) -> np.ndarray:
+def or_shifted(target: np.ndarray, source: np.ndarray, shift_y: int, shift_x: int) -> None:
     """
-    Extracts the panels from the image with splitting the joint panels
+    In place, ORs target[y, x] with source[y + shift_y, x + shift_x] where that pixel exists
+    """
+    height, width = target.shape
+    if abs(shift_y) >= height or abs(shift_x) >= width:
+        return
+    target_rows = slice(max(0, -shift_y), height - max(0, shift_y))
+    target_columns = slice(max(0, -shift_x), width - max(0, shift_x))
+    source_rows = slice(max(0, shift_y), height - max(0, -shift_y))
+    source_columns = slice(max(0, shift_x), width - max(0, -shift_x))
+    target[target_rows, target_columns] |= source[source_rows, source_columns]
+
+
+def dilate_with_line_kernel(image: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """
+    Same as cv2.dilate(image, kernel) for a kernel that is a straight, 1 pixel thick line segment
+
+    The dilation is the union of the image shifted along the segment, which is built by doubling
+    the covered length at each step, so the cost grows with log(length) instead of length.
+    Other kernels fall back to cv2.dilate.
+    """
+    anchor = np.array([kernel.shape[0] // 2, kernel.shape[1] // 2])
+    offsets = np.argwhere(kernel) - anchor
+    steps = np.diff(offsets, axis=0)
+    if len(offsets) < 2 or np.abs(steps[0]).max() != 1 or (steps != steps[0]).any():
+        return cv2.dilate(image, kernel, iterations=1)
+
+    step_y, step_x = steps[0]
+    start_y, start_x = offsets[0]
+    length = len(offsets)
+
+    # The segment starts at the first kernel offset, pad on that side so the segments
+    # of the pixels near the border still see the whole image
+    pad_top, pad_bottom = max(0, -start_y), max(0, start_y)
+    pad_left, pad_right = max(0, -start_x), max(0, start_x)
+    covered = cv2.copyMakeBorder(image, pad_top, pad_bottom, pad_left, pad_right, cv2.BORDER_CONSTANT, value=0)
+
+    # covered[p] = OR of image[p + k * step] for k in [0, span)
+    span = 1
+    while span * 2 <= length:
+        or_shifted(covered, covered.copy(), span * step_y, span * step_x)
+        span *= 2
+    if span < length:
+        or_shifted(covered, covered.copy(), (length - span) * step_y, (length - span) * step_x)
+
+    image_height, image_width = image.shape
+    top, left = pad_top + start_y, pad_left + start_x
+    return np.ascontiguousarray(covered[top:top + image_height, left:left + image_width])
+
+
+# 3x3 patterns of the line ends, in the same order as the kernels of build_dilation_kernels
+MATCH_KERNELS = (
+    # up
+    np.array([[0, 0, 0], [0, 1, 0], [0, 1, 0]], np.uint8),
+    # down
+    np.array([[0, 1, 0], [0, 1, 0], [0, 0, 0]], np.uint8),
+    # left
+    np.array([[0, 0, 0], [0, 1, 1], [0, 0, 0]], np.uint8),
+    # right
+    np.array([[0, 0, 0], [1, 1, 0], [0, 0, 0]], np.uint8),
+    # down right diagonal
+    np.array([[1, 0, 0], [0, 1, 0], [0, 0, 0]], np.uint8),
+    # down left diagonal
+    np.array([[0, 0, 1], [0, 1, 0], [0, 0, 0]], np.uint8),
+    # up left diagonal
+    np.array([[0, 0, 0], [0, 1, 0], [0, 0, 1]], np.uint8),
+    # up right diagonal
+    np.array([[0, 0, 0], [0, 1, 0], [1, 0, 0]], np.uint8),
+)
+
+
+@lru_cache(maxsize=8)
+def build_dilation_kernels(image_height: int, image_width: int) -> tuple[np.ndarray, ...]:
+    """
+    Builds the kernels extending the line ends found with MATCH_KERNELS,
+    they only depend on the page size so they are cached, the pages of a chapter usually share it
     """
-    pixels_before = np.count_nonzero(background_mask)
-    background_mask = cv2.ximgproc.thinning(background_mask) 
-    
-    up_kernel = np.array([[0, 0, 0], [0, 1, 0], [0, 1, 0]], np.uint8)
-    down_kernel = np.array([[0, 1, 0], [0, 1, 0], [0, 0, 0]], np.uint8)
-    left_kernel = np.array([[0, 0, 0], [0, 1, 1], [0, 0, 0]], np.uint8)
-    right_kernel = np.array([[0, 0, 0], [1, 1, 0], [0, 0, 0]], np.uint8)
-
-    down_right_diagonal_kernel = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 0]], np.uint8)
-    down_left_diagonal_kernel = np.array([[0, 0, 1], [0, 1, 0], [0, 0, 0]], np.uint8)
-    up_left_diagonal_kernel = np.array([[0, 0, 0], [0, 1, 0], [0, 0, 1]], np.uint8)
-    up_right_diagonal_kernel = np.array([[0, 0, 0], [0, 1, 0], [1, 0, 0]], np.uint8)
-    
     PAGE_TO_JOINT_OBJECT_RATIO = 3
-    image_height, image_width = grayscale_image.shape
 
     height_based_size = image_height // PAGE_TO_JOINT_OBJECT_RATIO
     width_based_size = (2 * image_width) // PAGE_TO_JOINT_OBJECT_RATIO
@@ -195,18 +301,7 @@ def joint_panel_split_extraction(grayscale_image: np.ndarray, background_mask: n
     down_left_dilation_kernel = np.flip(np.identity(min_based_size // 2 + 1, dtype=np.uint8), axis=1)
     down_left_dilation_kernel = np.pad(down_left_dilation_kernel, ((0, min_based_size // 2), (min_based_size // 2, 0)))
 
-    match_kernels = [
-        up_kernel,
-        down_kernel,
-        left_kernel,
-        right_kernel,
-        down_right_diagonal_kernel,
-        down_left_diagonal_kernel,
-        up_left_diagonal_kernel,
-        up_right_diagonal_kernel,
-    ]
-
-    dilation_kernels = [
+    dilation_kernels = (
         up_dilation_kernel,
         down_dilation_kernel,
         left_dilation_kernel,
@@ -215,28 +310,59 @@ def joint_panel_split_extraction(grayscale_image: np.ndarray, background_mask: n
         down_left_dilation_kernel,
         up_left_dilation_kernel,
         up_right_dilation_kernel,
-    ]
+    )
+    # The cached kernels are shared by every call
+    for kernel in dilation_kernels:
+        kernel.setflags(write=False)
+    return dilation_kernels
 
-    def get_dots(grayscale_image: np.ndarray, kernel: np.ndarray) -> tuple[np.ndarray, int]:
-        temp = cv2.matchTemplate(grayscale_image, kernel, cv2.TM_CCOEFF_NORMED)
-        _, temp = cv2.threshold(temp, 0.9, 1, cv2.THRESH_BINARY)
-        temp = np.where(temp == 1, 255, 0).astype(np.uint8)
-        pad_height = (kernel.shape[0] - 1) // 2
-        pad_width = (kernel.shape[1] - 1) // 2
-        temp = cv2.copyMakeBorder(temp, pad_height, kernel.shape[0] - pad_height - 1, pad_width, kernel.shape[1] - pad_width - 1, cv2.BORDER_CONSTANT, value=0)
-        return temp
+
+def joint_panel_split_extraction(grayscale_image: np.ndarray, background_mask: np.ndarray, pixels_before: int | None = None) -> np.ndarray:
+    """
+    Extracts the panels from the image with splitting the joint panels,
+    pixels_before is the area of the background mask when the caller already counted it
+    """
+    if pixels_before is None:
+        pixels_before = cv2.countNonZero(background_mask)
+    background_mask = thin_binary_image(background_mask)
+    
+    match_kernels = MATCH_KERNELS
+    dilation_kernels = build_dilation_kernels(*grayscale_image.shape)
+
+    def get_dots(grayscale_image: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+        # The mask and the 3x3 kernels are both binary, for which a normalized correlation above 0.9
+        # only happens when the neighborhood is exactly the kernel pattern. So instead of running
+        # matchTemplate over the whole image, only the neighborhoods of the (sparse) mask pixels are compared.
+        # Every kernel has its center set, which is why only the mask pixels can match.
+        image_height, image_width = grayscale_image.shape
+        flat_image = grayscale_image.ravel()
+        indices = np.flatnonzero(flat_image)
+        rows, columns = np.divmod(indices, image_width)
+        # Pixels on the image border have no full neighborhood and never match
+        indices = indices[(rows > 0) & (rows < image_height - 1) & (columns > 0) & (columns < image_width - 1)]
+
+        matches = np.ones(indices.size, bool)
+        for (dy, dx), expected in np.ndenumerate(kernel):
+            if dy == 1 and dx == 1:
+                continue
+            neighbors = flat_image[indices + ((dy - 1) * image_width + (dx - 1))]
+            matches &= (neighbors != 0) == bool(expected)
+
+        dots = np.zeros_like(grayscale_image)
+        dots.ravel()[indices[matches]] = 255
+        return dots
     
     for match_kernel, dilation_kernel in zip(match_kernels, dilation_kernels):
         dots = get_dots(background_mask, match_kernel)
-        lines = cv2.dilate(dots, dilation_kernel, iterations=1)
+        lines = dilate_with_line_kernel(dots, dilation_kernel)
         background_mask = cv2.bitwise_or(background_mask, lines)
 
-    pixels_now = np.count_nonzero(background_mask)
+    pixels_now = cv2.countNonZero(background_mask)
     dilation_size = pixels_before // (4  * pixels_now)
     dilation_size += dilation_size % 2 + 1
     background_mask = cv2.dilate(background_mask, np.ones((dilation_size, dilation_size), np.uint8), iterations=1)
 
-    page_without_background = 255 - background_mask
+    page_without_background = cv2.bitwise_not(background_mask)
 
     return page_without_background
 
@@ -249,22 +375,47 @@ def is_contour_sufficiently_big(contour: np.ndarray, image_height: int, image_wi
     return area > area_threshold
 
 
+def filter_sufficiently_big_contours(contours: list[np.ndarray], image_height: int, image_width: int) -> list[np.ndarray]:
+    """
+    Same as filtering the contours with is_contour_sufficiently_big, with the threshold computed once
+
+    A contour never covers more than its bounding rectangle,
+    so the small ones are rejected without computing their area
+    """
+    PAGE_TO_PANEL_RATIO = 32
+    image_area = image_width * image_height
+    area_threshold = image_area // PAGE_TO_PANEL_RATIO
+    big_contours = []
+    for contour in contours:
+        _, _, w, h = cv2.boundingRect(contour)
+        if w * h <= area_threshold:
+            continue
+        if cv2.contourArea(contour) > area_threshold:
+            big_contours.append(contour)
+    return big_contours
+
+
 def threshold_extraction(
         image: np.ndarray, 
         grayscale_image: np.ndarray, 
         mode: str = OutputMode.BOUNDING,
+        precomputed_laplacian: np.ndarray | None = None,
 ) -> list[np.ndarray]:
     """
-    Extracts panels from the image using thresholding
+    Extracts panels from the image using thresholding,
+    precomputed_laplacian is the result of preprocess_image when the caller already has it
     """
-    processed_image = cv2.GaussianBlur(grayscale_image, (3, 3), 0)
-    processed_image = cv2.Laplacian(processed_image, -1)
-    _, thresh = cv2.threshold(processed_image, 8, 255, cv2.THRESH_BINARY)
+    if precomputed_laplacian is None:
+        processed_image = cv2.GaussianBlur(grayscale_image, (3, 3), 0, dst=get_scratch_buffer("blurred", grayscale_image.shape))
+        processed_image = cv2.Laplacian(processed_image, -1, dst=get_scratch_buffer("laplacian", grayscale_image.shape))
+    else:
+        processed_image = precomputed_laplacian
+    _, thresh = cv2.threshold(processed_image, 8, 255, cv2.THRESH_BINARY, dst=get_scratch_buffer("thresholded", grayscale_image.shape))
     processed_image = apply_adaptive_threshold(processed_image)
-    processed_image = cv2.subtract(processed_image, thresh)
-    processed_image = cv2.dilate(processed_image, np.ones((3, 3), np.uint8), iterations=2)
+    processed_image = cv2.subtract(processed_image, thresh, dst=processed_image)
+    processed_image = cv2.dilate(processed_image, SQUARE_KERNEL_3, iterations=2)
     contours, _ = cv2.findContours(processed_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = list(filter(lambda c: is_contour_sufficiently_big(c, image.shape[0], image.shape[1]), contours))
+    contours = filter_sufficiently_big_contours(contours, image.shape[0], image.shape[1])
     panels = extract_panels(image, contours, False, mode=mode)
 
     return panels
@@ -276,11 +427,11 @@ def get_page_without_background(grayscale_image: np.ndarray, background_mask: np
     """
     STRIPE_FORMAT_MASK_AREA_RATIO = 0.3
 
-    mask_area = np.count_nonzero(background_mask)
+    mask_area = cv2.countNonZero(background_mask)
     mask_area_ratio = mask_area / background_mask.size
 
     if STRIPE_FORMAT_MASK_AREA_RATIO > mask_area_ratio and split_joint_panels:
-        page_without_background = joint_panel_split_extraction(grayscale_image, background_mask)
+        page_without_background = joint_panel_split_extraction(grayscale_image, background_mask, pixels_before=mask_area)
     else:
         page_without_background = cv2.subtract(grayscale_image, background_mask)
 
@@ -293,6 +444,7 @@ def get_fallback_panels(
         fallback: bool, 
         panels: list[np.ndarray],
         mode: str = OutputMode.BOUNDING,
+        precomputed_laplacian: np.ndarray | None = None,
 ) -> list[np.ndarray]:
     """
     Checks if the fallback is needed and returns the appropriate panels
@@ -301,9 +453,10 @@ def get_fallback_panels(
     - mode: The mode to use for extraction
         - 'masked': Extracts the panels by cuting out only the inside of the contours
         - 'bounding': Extracts the panels by using the bounding boxes of the contours
+    - precomputed_laplacian: The result of preprocess_image for grayscale_image, if already computed
     """
     if fallback and len(panels) < 2:
-        tmp = threshold_extraction(image, grayscale_image, mode=mode)
+        tmp = threshold_extraction(image, grayscale_image, mode=mode, precomputed_laplacian=precomputed_laplacian)
         if len(tmp) > len(panels):
             return tmp
     
@@ -329,12 +482,27 @@ def generate_panel_blocks(
     - rtl_order: If True, sort panels from right-to-left. Otherwise, left-to-right.
     """
 
+    # The panels are found on a smaller copy of very large pages, their contours
+    # are scaled back so the panels themselves are cut from the full resolution page
+    MASK_MAX_SIZE = 3000
+    scale = min(1.0, MASK_MAX_SIZE / max(image.shape[:2]))
+
     grayscale_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    processed_image = preprocess_image_with_dilation(grayscale_image)
+    if scale < 1.0:
+        mask_grayscale_image = cv2.resize(grayscale_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
+    else:
+        mask_grayscale_image = grayscale_image
+    # The blurred Laplacian is shared by the mask and by the threshold fallback
+    laplacian = preprocess_image(mask_grayscale_image)
+    processed_image = preprocess_image_with_dilation(mask_grayscale_image, precomputed_laplacian=laplacian)
     background_mask = background_generator(processed_image)
-    page_without_background = get_page_without_background(grayscale_image, background_mask, split_joint_panels)
+    page_without_background = get_page_without_background(mask_grayscale_image, background_mask, split_joint_panels)
     contours, _ = cv2.findContours(page_without_background, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = list(filter(lambda c: is_contour_sufficiently_big(c, image.shape[0], image.shape[1]), contours))
+    contours = filter_sufficiently_big_contours(contours, *mask_grayscale_image.shape)
+    if scale < 1.0:
+        # Maps the pixel centers back to the full resolution, without going past the last pixel
+        last_pixel = (image.shape[1] - 1, image.shape[0] - 1)
+        contours = [np.minimum(np.round((contour + 0.5) / scale - 0.5), last_pixel).astype(np.int32) for contour in contours]
     
     # Sort by top-to-bottom (y-coordinate) first, then by horizontal order.
     # For RTL, we sort by x-coordinate in descending order (by negating it).
@@ -344,7 +512,8 @@ def generate_panel_blocks(
 
     def get_panels(contours):
         panels = extract_panels(image, contours, mode=mode)
-        panels = get_fallback_panels(image, grayscale_image, fallback, panels, mode=mode)
+        # The fallback works on the full resolution page, the Laplacian only fits it when the page was not scaled
+        panels = get_fallback_panels(image, grayscale_image, fallback, panels, mode=mode, precomputed_laplacian=laplacian if scale == 1.0 else None)
         return panels
 
     panels = []
@@ -373,15 +542,51 @@ def generate_panel_blocks_by_ai(
     Parameters:
     - rtl_order: If True, sort panels from right-to-left. Otherwise, left-to-right.
     """
-    grayscale_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    processed_image = preprocess_image(grayscale_image)
+    return generate_panel_blocks_by_ai_batch([image], merge=merge, rtl_order=rtl_order)[0]
+
+
+def generate_panel_blocks_by_ai_batch(
+        images: list[np.ndarray],
+        merge: str = MergeMode.NONE,
+        rtl_order: bool = False
+) -> list[list[np.ndarray]]:
+    """
+    Generates the separate panel images from each of the base images using AI with merge,
+    running the model once for the whole batch
+    
+    Parameters:
+    - rtl_order: If True, sort panels from right-to-left. Otherwise, left-to-right.
+    """
+    if not images:
+        return []
+
+    processed_images = [preprocess_image(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)) for image in images]
 
     warnings.filterwarnings("ignore", category=FutureWarning) # Ignore 'FutureWarning: `torch.cuda.amp.autocast(args...)` is deprecated. Please use `torch.amp.autocast('cuda', args...)` instead.'
-    results = model(processed_image)
+    results = model(processed_images)
     warnings.filterwarnings("default", category=FutureWarning)
 
+    return [
+        get_panels_from_detections(image, detections, merge=merge, rtl_order=rtl_order)
+        for image, detections in zip(images, results.xyxy)
+    ]
+
+
+def get_panels_from_detections(
+        image: np.ndarray,
+        detections,
+        merge: str = MergeMode.NONE,
+        rtl_order: bool = False
+) -> list[np.ndarray]:
+    """
+    Crops the panels of the image from the AI detections of that image
+    
+    Parameters:
+    - detections: The predictions of the image in (x1, y1, x2, y2, confidence, class) format
+    - rtl_order: If True, sort panels from right-to-left. Otherwise, left-to-right.
+    """
     bounding_boxes = []
-    for detection in results.xyxy[0]:  # Access predictions in (x1, y1, x2, y2, confidence, class) format
+    for detection in detections:  # Access predictions in (x1, y1, x2, y2, confidence, class) format
         x1, y1, x2, y2, conf, cls = detection.tolist()  # Convert to Python list
         x1, y1, x2, y2 = map(int, [x1, y1, x2, y2])
         bounding_boxes.append((x1, y1, x2 - x1, y2 - y1))
@@ -413,6 +618,23 @@ def generate_panel_blocks_by_ai(
     return panels
 
 
+def write_panels_in_background(
+        writer: ThreadPoolExecutor,
+        output_dir: str,
+        image_name: str,
+        image_ext: str,
+        panel_blocks: list[np.ndarray]
+        ) -> list[Future]:
+    """
+    Queues the panels of an image to be written by the writer threads,
+    cv2.imwrite releases the GIL while encoding so the caller can move on to the next image
+    """
+    return [
+        writer.submit(cv2.imwrite, os.path.join(output_dir, f"{image_name}_{k}{image_ext}"), panel)
+        for k, panel in enumerate(panel_blocks)
+    ]
+
+
 def extract_panels_for_image(
         image_path: str, 
         output_dir: str, 
@@ -430,9 +652,10 @@ def extract_panels_for_image(
     image = load_image(os.path.dirname(image_path), image_path)
     image_name, image_ext = os.path.splitext(image.image_name)
     panel_blocks = generate_panel_blocks(image.image, split_joint_panels=split_joint_panels, fallback=fallback, mode=mode, merge=merge)
-    for k, panel in enumerate(tqdm(panel_blocks, total=len(panel_blocks))):
-        out_path = os.path.join(output_dir, f"{image_name}_{k}{image_ext}")
-        cv2.imwrite(out_path, panel)
+    with ThreadPoolExecutor(max_workers=2) as writer:
+        futures = write_panels_in_background(writer, output_dir, image_name, image_ext, panel_blocks)
+        for future in tqdm(futures, total=len(futures)):
+            future.result()
 
 
 def extract_panels_for_images_in_folder(
@@ -452,16 +675,55 @@ def extract_panels_for_images_in_folder(
     files = os.listdir(input_dir)
     num_files = len(files)
     num_panels = 0
-    for _, image in enumerate(tqdm(load_images(input_dir), total=num_files)):
-        image_name, image_ext = os.path.splitext(image.image_name)
-        panel_blocks = generate_panel_blocks(image.image, fallback=fallback, split_joint_panels=split_joint_panels, mode=mode, merge=merge)
-        for j, panel in enumerate(panel_blocks):
-            out_path = os.path.join(output_dir, f"{image_name}_{j}{image_ext}")
-            cv2.imwrite(out_path, panel)
-        num_panels += len(panel_blocks)
+    image_names = [file_name for file_name in get_file_names(input_dir) if get_file_extension(file_name) in supported_types]
+    extract = partial(
+        _extract_panels_for_image_in_folder,
+        input_dir=input_dir,
+        output_dir=output_dir,
+        fallback=fallback,
+        split_joint_panels=split_joint_panels,
+        mode=mode,
+        merge=merge
+    )
+    # Every image is independent, so they are spread over one process per core
+    with ProcessPoolExecutor(initializer=_init_folder_worker) as executor:
+        for panel_count in tqdm(executor.map(extract, image_names, chunksize=4), total=num_files):
+            num_panels += panel_count
     return (num_files, num_panels)
 
 
+def _init_folder_worker() -> None:
+    """
+    Runs once in every worker process of extract_panels_for_images_in_folder
+    """
+    # The pool already uses every core, OpenCV's own threads would only oversubscribe them
+    cv2.setNumThreads(1)
+
+
+def _extract_panels_for_image_in_folder(
+        image_name: str,
+        input_dir: str,
+        output_dir: str,
+        fallback: bool,
+        split_joint_panels: bool,
+        mode: str,
+        merge: str
+        ) -> int:
+    """
+    Extracts and writes the panels of one image of the input folder, returns the number of panels
+    """
+    image = load_image(input_dir, image_name)
+    image_name, image_ext = os.path.splitext(image.image_name)
+    panel_blocks = generate_panel_blocks(image.image, fallback=fallback, split_joint_panels=split_joint_panels, mode=mode, merge=merge)
+    # Only the panels of this page are written in parallel. They are all written before returning,
+    # so write errors reach the caller and the returned count matches the files on disk.
+    # The other worker processes keep computing while this one writes.
+    with ThreadPoolExecutor(max_workers=2) as writer:
+        for future in write_panels_in_background(writer, output_dir, image_name, image_ext, panel_blocks):
+            future.result()
+    return len(panel_blocks)
+
+
 def extract_panels_for_images_in_folder_by_ai(
         input_dir: str, 
         output_dir: str
@@ -475,11 +737,29 @@ def extract_panels_for_images_in_folder_by_ai(
     files = os.listdir(input_dir)
     num_files = len(files)
     num_panels = 0
-    for _, image in enumerate(tqdm(load_images(input_dir), total=num_files)):
-        image_name, image_ext = os.path.splitext(image.image_name)
-        panel_blocks = generate_panel_blocks_by_ai(image.image)
-        for j, panel in enumerate(panel_blocks):
-            out_path = os.path.join(output_dir, f"{image_name}_{j}{image_ext}")
-            cv2.imwrite(out_path, panel)
-        num_panels += len(panel_blocks)
+    image_names = [file_name for file_name in get_file_names(input_dir) if get_file_extension(file_name) in supported_types]
+
+    # The model runs once per batch of pages
+    batches = [image_names[i:i + AI_BATCH_SIZE] for i in range(0, len(image_names), AI_BATCH_SIZE)]
+
+    def load_batch(batch: list[str]) -> list[ImageWithFilename]:
+        return [load_image(input_dir, image_name) for image_name in batch]
+
+    futures = []
+    # The next batch is read while the current one is detected,
+    # and the panels of a batch are written while the next one is processed
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=2) as writer, tqdm(total=num_files) as progress:
+        next_images = reader.submit(load_batch, batches[0]) if batches else None
+        for k in range(len(batches)):
+            images = next_images.result()
+            if k + 1 < len(batches):
+                next_images = reader.submit(load_batch, batches[k + 1])
+            panel_blocks_per_image = generate_panel_blocks_by_ai_batch([image.image for image in images])
+            for image, panel_blocks in zip(images, panel_blocks_per_image):
+                image_name, image_ext = os.path.splitext(image.image_name)
+                futures.extend(write_panels_in_background(writer, output_dir, image_name, image_ext, panel_blocks))
+                num_panels += len(panel_blocks)
+            progress.update(len(images))
+    for future in futures:
+        future.result()
     return (num_files, num_panels)